@@ -16,16 +16,24 @@
 ### END LICENSE
 import json
 import logging
+import multiprocessing
 import optparse
 import os
 import random
+import shutil
 import signal
 import sys
 import time
-from multiprocessing import Process, Queue
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
 
 from .AttrDict import AttrDict
 
+try:
+    import pyvips
+except (ImportError, OSError):  # OSError when pyvips is installed, but libvips can't be loaded
+    pyvips = None  # optional, images are decoded with GdkPixbuf then
+
 # fmt: off
 import gi  # isort:skip
 gi.require_version('Gtk', '3.0')
@@ -40,19 +48,119 @@ Gtk.init(sys.argv)
 # fmt: on
 
 
-IMAGE_TYPES = (".jpg", ".jpeg", ".png", ".bmp")
+IMAGE_TYPES = frozenset((".jpg", ".jpeg", ".png", ".bmp"))
 
 SECONDS = 6
 FADE = 0.5
 ZOOM = 0.2
 PAN = 0.05
+MAX_FILES = 2000
+
+CONFIG_DIR = os.path.expanduser("~/.config/variety/")
+CONFIG_FILE = os.path.join(CONFIG_DIR, "variety_slideshow.json")
+
+# How many images to keep decoded ahead of time
+PREFETCH = 3
+
+# Images are never decoded larger than this many times the monitor size, whatever the zoom
+MAX_DECODE_SCALE = 2
+
+# Where SharedMemory keeps its buffers on Linux
+SHM_DIR = "/dev/shm"
 
 random.seed(time.time())
 logging.basicConfig()
 
 
+def has_image_extension(filename):
+    """Only checks the name - callers must make sure it is a regular file, as a broken symlink,
+    FIFO or device node can have an image extension too"""
+    return os.path.splitext(filename)[1].lower() in IMAGE_TYPES
+
+
 def is_image(filename):
-    return os.path.isfile(filename) and filename.lower().endswith(IMAGE_TYPES)
+    return os.path.isfile(filename) and has_image_extension(filename)
+
+
+def random_pan(pan_px):
+    """Random offset of pan_px to 2 * pan_px, in a random direction"""
+    return random.choice((-1, 1)) * pan_px * (1 + random.random())
+
+
+def find_images(folder):
+    """Yields os.DirEntry objects for the image files in folder and its subfolders, top-down,
+    like os.walk. Symlinks to folders are not followed. Stops scanning as soon as the caller
+    stops iterating."""
+    folders = [folder]
+    while folders:
+        subfolders = []
+        try:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subfolders.append(entry.path)
+                        elif has_image_extension(entry.name) and entry.is_file():
+                            yield entry
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        folders.extend(reversed(subfolders))
+
+
+def load_pixbuf(filename, max_w, max_h):
+    """Loads an image scaled to fit in max_w x max_h, preserving its aspect ratio.
+    The target size is given to the loader before decoding starts, so loaders that can
+    decode at a reduced size (libjpeg scales by 1/2, 1/4 or 1/8) skip most of the work."""
+
+    def on_size_prepared(loader, w, h):
+        ratio = min(max_w / w, max_h / h)
+        loader.set_size(max(1, round(w * ratio)), max(1, round(h * ratio)))
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    loader = GdkPixbuf.PixbufLoader.new()
+    loader.connect("size-prepared", on_size_prepared)
+    loader.write(data)
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    if not pixbuf:
+        raise ValueError("No image data in %s" % filename)
+    return pixbuf
+
+
+def load_pixels(filename, max_w, max_h):
+    """Returns (pixels, has_alpha, width, height, rowstride) for the image, scaled down to fit
+    in max_w x max_h. Uses libvips when available, as its shrink-on-load is considerably faster
+    for large JPEGs, and GdkPixbuf otherwise or for formats this libvips build can't read."""
+    if pyvips:
+        try:
+            image = pyvips.Image.thumbnail(
+                filename, max_w, height=max_h, size="down", no_rotate=True
+            )
+            if image.interpretation != "srgb":
+                image = image.colourspace("srgb")
+            return (
+                image.write_to_memory(),
+                image.hasalpha(),
+                image.width,
+                image.height,
+                image.width * image.bands,
+            )
+        except pyvips.Error:
+            pass
+
+    pixbuf = load_pixbuf(filename, max_w, max_h)
+    return (
+        # one copy into a Python bytes object - loader pixbufs own their pixels, so
+        # read_pixel_bytes() would only add a second one
+        pixbuf.get_pixels(),
+        pixbuf.get_has_alpha(),
+        pixbuf.get_width(),
+        pixbuf.get_height(),
+        pixbuf.get_rowstride(),
+    )
 
 
 class VarietySlideshow:
@@ -75,22 +183,18 @@ class VarietySlideshow:
             return
 
         try:
-            configdir = os.path.expanduser("~/.config/variety/")
-            configfile = os.path.join(configdir, "variety_slideshow.json")
-            with open(configfile, encoding="utf8") as f:
+            with open(CONFIG_FILE, encoding="utf8") as f:
                 self.options = AttrDict(json.load(f))
         except:
             self.options = AttrDict()
 
     def save_options(self):
         try:
-            configdir = os.path.expanduser("~/.config/variety/")
             try:
-                os.makedirs(configdir)
+                os.makedirs(CONFIG_DIR)
             except:
                 pass
-            configfile = os.path.join(configdir, "variety_slideshow.json")
-            with open(configfile, "w", encoding="utf8") as f:
+            with open(CONFIG_FILE, "w", encoding="utf8") as f:
                 json.dump(self.options, f, ensure_ascii=False)
         except:
             logging.exception("Could not save options:")
@@ -156,7 +260,7 @@ Starts a slideshow using the given images and/or image folders. Options are auto
 In what order to cycle the files. Possible values are:
 random - random order (Default);
 keep - keep order, specified on the commandline (only useful when specifying files, not folders);
-name - sort by folder name, then by filename;
+name - sort by folder name, then by filename, ignoring case;
 date - sort by file date;""",
         )
 
@@ -168,6 +272,17 @@ date - sort by file date;""",
             help="Sort order: asc/ascending (this is the default), or desc/descending",
         )
 
+        parser.add_option(
+            "--max-files",
+            action="store",
+            type="int",
+            dest="max_files",
+            default=self.options.get("max_files", MAX_FILES),
+            help="Stop looking for images after this many are found.\n"
+            "Default is %s.\n"
+            "Integer, at least 1." % MAX_FILES,
+        )
+
         parser.add_option(
             "--monitor",
             action="store",
@@ -255,6 +370,9 @@ date - sort by file date;""",
         if self.options.pan < 0:
             parser.error("Pan should be at least 0")
 
+        if self.options.max_files < 1:
+            parser.error("Max files should be at least 1")
+
         self.options.mode = self.options.mode.lower()
         if self.options.mode not in (
             "fullscreen",
@@ -278,24 +396,18 @@ date - sort by file date;""",
         self.cursor = 0
 
         for arg in self.options.files_and_folders:
+            if len(self.files) >= self.options.max_files:
+                break
+
             path = os.path.abspath(os.path.expanduser(arg))
             if is_image(path):
                 self.files.append(path)
 
             elif os.path.isdir(path):
-                for root, dirnames, filenames in os.walk(path):
-                    for filename in filenames:
-                        full_path = os.path.join(root, filename)
-                        if is_image(full_path):
-                            self.files.append(full_path)
-                        if len(self.files) > 2000:
-                            break
-                    else:
-                        continue
-                    break
-                else:
-                    continue
-                break
+                for entry in find_images(path):
+                    self.files.append(entry.path)
+                    if len(self.files) >= self.options.max_files:
+                        break
 
         if not self.files:
             self.parser.error("You should specify some files or folders")
@@ -304,7 +416,7 @@ date - sort by file date;""",
         if sort == "keep":
             pass
         elif sort == "name":
-            self.files.sort()
+            self.files.sort(key=str.lower)
         elif sort == "date":
             self.files.sort(key=os.path.getmtime)
         else:
@@ -313,25 +425,32 @@ date - sort by file date;""",
         if self.options.sort_order.lower().startswith("desc"):
             self.files.reverse()
 
+        self.num_files = len(set(self.files))
+
     def get_next_file(self):
         if not self.running:
             return None
         if len(self.queued):
             return self.queued.pop(0)
         else:
-            if self.error_files == set(self.files):
+            # error_files only ever gets files from self.files (queue() makes sure of that),
+            # so comparing sizes is enough
+            if len(self.error_files) >= self.num_files:
                 logging.error("Could not find any non-corrupt images, exiting.")
                 self.quit()
                 return None
 
-            f = self.files[self.cursor]
-            self.cursor = (self.cursor + 1) % len(self.files)
-            if f in self.error_files:
-                return self.get_next_file()
-            else:
-                return f
+            # there is at least one good file, so this finishes within one pass over the files
+            while True:
+                f = self.files[self.cursor]
+                self.cursor = (self.cursor + 1) % len(self.files)
+                if f not in self.error_files:
+                    return f
 
     def queue(self, filename):
+        if filename not in self.files:
+            logging.warning("Not queueing %s, it is not one of the slideshow's files" % filename)
+            return
         self.queued.append(filename)
 
     def connect_signals(self):
@@ -383,6 +502,10 @@ date - sort by file date;""",
         self.stage.connect("key-press-event", on_key_press)
         self.stage.connect("button-press-event", on_button_press)
         self.stage.connect("motion-event", on_motion)
+        self.stage.connect("allocation-changed", self.on_stage_allocation_changed)
+
+    def on_stage_allocation_changed(self, stage, box, flags):
+        self.stage_w, self.stage_h = box.get_width(), box.get_height()
 
     def run(self):
         self.running = True
@@ -393,6 +516,8 @@ date - sort by file date;""",
         self.parse_options()  # parses the command-line arguments, these take precedence over the saved config
         self.save_options()
         self.prepare_file_queues()
+        self.allocate_pixel_buffers()
+        self.start_decoder()
 
         self.window.set_title(self.options.title)
         self.screen = self.window.get_screen()
@@ -402,14 +527,19 @@ date - sort by file date;""",
         self.embed.set_visible(True)
 
         self.stage = self.embed.get_stage()
+        self.stage_w, self.stage_h = self.stage.get_size()
         self.stage.set_color(Clutter.Color.get_static(Clutter.StaticColor.BLACK))
         if self.options.mode == "fullscreen":
             self.stage.hide_cursor()
 
-        self.texture = Clutter.Texture.new()
-        self.next_texture = None
-        self.prev_texture = None
-        self.data_queue = Queue()
+        # Two textures are reused for the whole slideshow: while one is shown, the next image is
+        # loaded into the other one, then they are cross-faded.
+        self.textures = (Clutter.Texture.new(), Clutter.Texture.new())
+        for texture in self.textures:
+            texture.set_opacity(0)
+            texture.set_keep_aspect_ratio(True)
+            self.stage.add_actor(texture)
+        self.texture = self.textures[0]
 
         self.connect_signals()
 
@@ -447,7 +577,8 @@ date - sort by file date;""",
         def after_show(*args):
             def f():
                 self.move_to_monitor(self.options.monitor)
-                self.prepare_next_data()
+                for _ in range(PREFETCH):
+                    self.prepare_next_data()
                 self.go_next()
 
             GObject.timeout_add(200, f)
@@ -459,8 +590,51 @@ date - sort by file date;""",
     def quit(self, *args):
         logging.info("Exiting...")
         self.running = False
+        self.stop_decoder()
+        self.release_pixel_buffers()
         Gtk.main_quit()
 
+    def allocate_pixel_buffers(self):
+        # Decoded pixels are handed over to us through shared memory, so only a small
+        # metadata tuple has to go through the data pipe. There is one buffer per prefetched image,
+        # each sized for the largest monitor (at the maximum zoom), at 4 bytes per pixel.
+        # If there isn't comfortably enough room for them, the decoder sends the pixels
+        # through the pipe instead: slower, but writing to a full tmpfs would crash it.
+        screen = Gdk.Screen.get_default()
+        geometries = [screen.get_monitor_geometry(i) for i in range(screen.get_n_monitors())]
+        scale = min(1 + 2 * self.options.zoom, MAX_DECODE_SCALE)
+        self.max_decode_w = int(max(g.width for g in geometries) * scale)
+        self.max_decode_h = int(max(g.height for g in geometries) * scale)
+        size = self.max_decode_w * self.max_decode_h * 4
+        self.pixel_buffers = []
+        self.next_pixel_buffer = 0
+
+        try:
+            free = shutil.disk_usage(SHM_DIR).free
+        except OSError:
+            free = 0
+        if size * PREFETCH > free / 2:
+            logging.warning(
+                "Not enough free space in %s, passing images through a pipe instead" % SHM_DIR
+            )
+            return
+
+        try:
+            for _ in range(PREFETCH):
+                self.pixel_buffers.append(SharedMemory(create=True, size=size))
+        except OSError:
+            logging.exception("Could not allocate shared memory, passing images through a pipe:")
+            self.release_pixel_buffers()
+
+    def release_pixel_buffers(self):
+        for shm in self.pixel_buffers:
+            try:
+                shm.close()
+                shm.unlink()
+            except:
+                logging.exception("Could not release shared memory %s:" % shm.name)
+        self.pixel_buffers = []
+
     def move_to_monitor(self, i):
         i = max(1, min(i, self.screen.get_n_monitors()))
         rect = self.screen.get_monitor_geometry(i - 1)
@@ -477,27 +651,49 @@ date - sort by file date;""",
                 GObject.source_remove(self.next_timeout)
                 delattr(self, "next_timeout")
 
-            image_data = self.data_queue.get(True, timeout=1)
+            if not self.data_reader.poll():
+                # not decoded yet - keep the main loop (and the current animation) running
+                self.next_timeout = GObject.timeout_add(
+                    50, self.go_next, priority=GLib.PRIORITY_HIGH
+                )
+                return
+
+            try:
+                image_data = self.data_reader.recv()
+            except EOFError:
+                image_data = None  # the decoder has died
+            if image_data is None:
+                # restart it outside of the except block, so the new process starts clean
+                self.restart_decoder()
+                return self.go_next()
+
+            filename, max_w, max_h = self.decode_requests.popleft()
             if not isinstance(image_data, tuple):
-                if image_data:
-                    logging.info("Error in %s, skipping it" % image_data)
-                    self.error_files.add(image_data)
+                logging.info("Error in %s, skipping it" % image_data)
+                self.error_files.add(image_data)
                 self.prepare_next_data()
                 return self.go_next()
 
-            self.next_texture = self.create_texture(image_data)
-            target_size, target_position = self.initialize_pan_and_zoom(self.next_texture)
+            decode_w, decode_h = self.get_decode_size()
+            if max_w < decode_w or max_h < decode_h:
+                # prefetched before the stage grew (e.g. switching to fullscreen) - it would look
+                # blurry, so decode it again at the new size
+                self.queued.insert(0, filename)
+                self.prepare_next_data()
+                return self.go_next()
+
+            next_texture = (
+                self.textures[1] if self.texture is self.textures[0] else self.textures[0]
+            )
+            self.load_texture(next_texture, image_data)
+            target_size, target_position = self.initialize_pan_and_zoom(next_texture)
 
-            self.stage.add_actor(self.next_texture)
             self.toggle(self.texture, False)
-            self.toggle(self.next_texture, True)
+            self.toggle(next_texture, True)
 
-            self.start_pan_and_zoom(self.next_texture, target_size, target_position)
+            self.start_pan_and_zoom(next_texture, target_size, target_position)
 
-            if self.prev_texture:
-                self.prev_texture.destroy()
-            self.prev_texture = self.texture
-            self.texture = self.next_texture
+            self.texture = next_texture
 
             self.next_timeout = GObject.timeout_add(
                 int(self.interval), self.go_next, priority=GLib.PRIORITY_HIGH
@@ -508,70 +704,132 @@ date - sort by file date;""",
             self.next_timeout = GObject.timeout_add(100, self.go_next, priority=GLib.PRIORITY_HIGH)
 
     def get_ratio_to_screen(self, texture):
-        return max(
-            self.stage.get_width() / texture.get_width(),
-            self.stage.get_height() / texture.get_height(),
-        )
+        w, h = texture.get_base_size()
+        return max(self.stage_w / w, self.stage_h / h)
+
+    def start_decoder(self):
+        # A single long-lived decoder process, started once from run(). It has to be forked:
+        # with "spawn" or "forkserver" (the default on Linux since Python 3.14) the child would
+        # need a pickled copy of self, which holds Gtk objects, and importing this module in it
+        # would initialize Gtk.
+        # Requests and results go through one-way pipes: the messages are tiny, and unlike a Queue
+        # a pipe needs no feeder thread. Each process closes the pipe ends it doesn't use, so when
+        # either side dies, however it dies, the other one gets EOF instead of waiting forever.
+        fork = multiprocessing.get_context("fork")
+        request_reader, self.request_writer = fork.Pipe(duplex=False)
+        self.decode_requests = deque()  # (filename, max_w, max_h) for each pending request
+        self.data_reader, data_writer = fork.Pipe(duplex=False)
+        self.decoder = fork.Process(target=self.decode_loop, args=(request_reader, data_writer))
+        self.decoder.daemon = True
+        self.decoder.start()
+        request_reader.close()
+        data_writer.close()
+
+    def stop_decoder(self):
+        self.request_writer.close()
+        self.data_reader.close()
+
+    def restart_decoder(self):
+        # The decoder crashed (e.g. a segfault in a loader, or SIGBUS when /dev/shm filled up
+        # after all), most likely while decoding the oldest pending request. Skip that file and
+        # request the others again from a fresh decoder.
+        pending = [filename for filename, max_w, max_h in self.decode_requests]
+        if pending:
+            logging.error("The decoder process died while decoding %s, skipping it" % pending[0])
+            self.error_files.add(pending[0])
+        else:
+            logging.error("The decoder process died, restarting it")
+        self.stop_decoder()
+        self.decoder.join()
+        self.start_decoder()
+        self.queued[:0] = pending[1:]
+        for _ in pending:
+            self.prepare_next_data()
+
+    def decode_loop(self, request_reader, data_writer):
+        self.request_writer.close()
+        self.data_reader.close()
+        os.nice(20)
+        while True:
+            try:
+                request = request_reader.recv()
+                data_writer.send(self.decode(*request))
+            except (EOFError, BrokenPipeError):
+                return  # the main process is gone
+
+    def decode(self, filename, slot, max_w, max_h):
+        try:
+            pixels, has_alpha, width, height, rowstride = load_pixels(filename, max_w, max_h)
+            if slot is None:
+                # no shared memory, send the pixels themselves
+                return None, pixels, has_alpha, width, height, rowstride
+            self.pixel_buffers[slot].buf[: len(pixels)] = pixels
+            return slot, len(pixels), has_alpha, width, height, rowstride
+        except:
+            logging.exception("Could not open file %s" % filename)
+            return filename
 
     def prepare_next_data(self):
         filename = self.get_next_file()
         if not filename:
-            self.data_queue.put(None)
             return
 
-        def _prepare(filename):
-            os.nice(20)
-            max_w = self.stage.get_width() * (1 + 2 * self.options.zoom)
-            max_h = self.stage.get_height() * (1 + 2 * self.options.zoom)
-
-            try:
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, max_w, max_h, True)
-                data = (
-                    pixbuf.get_pixels(),
-                    pixbuf.get_has_alpha(),
-                    pixbuf.get_width(),
-                    pixbuf.get_height(),
-                    pixbuf.get_rowstride(),
-                    4 if pixbuf.get_has_alpha() else 3,
-                )
-                self.data_queue.put(data)
-            except:
-                logging.exception("Could not open file %s" % filename)
-                self.data_queue.put(filename)
-
-        p = Process(target=_prepare, args=(filename,))
-        p.daemon = True
-        p.start()
-
-    def create_texture(self, image_data):
-        data = tuple(image_data) + (Clutter.TextureFlags.NONE,)
-        texture = Clutter.Texture.new()
-        texture.set_from_rgb_data(*data)
+        if self.pixel_buffers:
+            slot = self.next_pixel_buffer
+            self.next_pixel_buffer = (slot + 1) % len(self.pixel_buffers)
+        else:
+            slot = None
+        max_w, max_h = self.get_decode_size()
+        self.decode_requests.append((filename, max_w, max_h))
+        try:
+            self.request_writer.send((filename, slot, max_w, max_h))
+        except BrokenPipeError:
+            pass  # the decoder has died, go_next will restart it and request this file again
+
+    def get_decode_size(self):
+        max_w = min(self.stage_w * (1 + 2 * self.options.zoom), self.max_decode_w)
+        max_h = min(self.stage_h * (1 + 2 * self.options.zoom), self.max_decode_h)
+        return int(max_w), int(max_h)
+
+    def load_texture(self, texture, image_data):
+        # data is either the pixels, or how many bytes of the shared buffer slot they take
+        slot, data, has_alpha, width, height, rowstride = image_data
+        pixels = data if slot is None else bytes(self.pixel_buffers[slot].buf[:data])
+        # the texture might still be fading out or panning if we were called early
+        texture.remove_all_transitions()
         texture.set_opacity(0)
-        texture.set_keep_aspect_ratio(True)
-        return texture
+        texture.set_from_rgb_data(
+            pixels,
+            has_alpha,
+            width,
+            height,
+            rowstride,
+            4 if has_alpha else 3,
+            Clutter.TextureFlags.NONE,
+        )
 
     def initialize_pan_and_zoom(self, texture):
         self.will_enlarge = not self.will_enlarge
 
-        pan_px = max(self.stage.get_width(), self.stage.get_height()) * self.options.pan
-        rand_pan = lambda: random.choice((-1, 1)) * (pan_px + pan_px * random.random())
+        stage_w, stage_h = self.stage_w, self.stage_h
+        pan_px = max(stage_w, stage_h) * self.options.pan
         zoom_factor = (1 + self.options.zoom) * (1 + self.options.zoom * random.random())
 
         scale = self.get_ratio_to_screen(texture)
-        base_w, base_h = texture.get_width() * scale, texture.get_height() * scale
+        w, h = texture.get_base_size()
+        base_w, base_h = w * scale, h * scale
 
         safety_zoom = 1 + self.options.pan / 2 if self.options.zoom > 0 else 1
 
         small_size = base_w * safety_zoom, base_h * safety_zoom
         big_size = base_w * safety_zoom * zoom_factor, base_h * safety_zoom * zoom_factor
         small_position = (
-            -(small_size[0] - self.stage.get_width()) / 2,
-            -(small_size[1] - self.stage.get_height()) / 2,
+            -(small_size[0] - stage_w) / 2,
+            -(small_size[1] - stage_h) / 2,
         )
         big_position = (
-            -(big_size[0] - self.stage.get_width()) / 2 + rand_pan(),
-            -(big_size[1] - self.stage.get_height()) / 2 + rand_pan(),
+            -(big_size[0] - stage_w) / 2 + random_pan(pan_px),
+            -(big_size[1] - stage_h) / 2 + random_pan(pan_px),
         )
 
         if self.will_enlarge:
@@ -594,6 +852,7 @@ date - sort by file date;""",
         texture.set_easing_duration(self.interval + self.fade_time)
         texture.set_size(*target_size)
         texture.set_position(*target_position)
+        texture.restore_easing_state()
 
     def toggle(self, texture, visible):
         texture.set_reactive(visible)
@@ -603,6 +862,7 @@ date - sort by file date;""",
         )
         texture.set_easing_duration(self.fade_time)
         texture.set_opacity(255 if visible else 0)
+        texture.restore_easing_state()
         if visible:
             self.stage.raise_child(texture, None)
 